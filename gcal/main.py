@@ -16,6 +16,8 @@ from pprint import pprint
 from time import time as epoch_time
 from zoneinfo import ZoneInfo
 
+import numpy as np
+
 from debug import DebugChannel
 from handy import prog,die,gripe,positive_int,CaselessString
 
@@ -49,6 +51,12 @@ DEFAULT_CALENDAR_WINDOW=90
 # For adding one day to a date or datetime.
 ONE_DAY=dt.timedelta(days=1)
 
+# Weekday abbreviations, indexed the way datetime.date.weekday() counts.
+WEEKDAYS=('mon','tue','wed','thu','fri','sat','sun')
+
+# How many of the busiest days --utilization lists in its table.
+BUSIEST_DAYS=5
+
 # Remove this prefix from auto-generated events' notes.
 AUTOGEN_WARNING='To see detailed information for automatically created events like this one, use the official Google Calendar app. https://g.co/calendar\n\n'
 
@@ -99,6 +107,34 @@ def date_validator(s):
     dc(f"{d=}")
     return d
 
+def work_hours_validator(s):
+    """Given a "HH:MM-HH:MM" string, return a (start,end) tuple of
+    datetime.time values (or raise a ValueError exception)."""
+
+    m=re.match(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$',s)
+    if not m:
+        raise ValueError(f"Invalid working hours: {s!r}")
+    h1,m1,h2,m2=(int(x) for x in m.groups())
+    start,end=dt.time(h1,m1),dt.time(h2,m2)
+    if start>=end:
+        raise ValueError(f"Working hours must end after they start: {s!r}")
+    return start,end
+
+def weekdays_validator(s):
+    """Given a CSV row of day names (Mon, Tue, ...), return the set of
+    corresponding weekday numbers, where Monday is 0 (or raise a
+    ValueError exception)."""
+
+    days=set()
+    for d in list_from_csv(s):
+        d=d[:3].lower()
+        if d not in WEEKDAYS:
+            raise ValueError(f"Invalid day name: {d!r}")
+        days.add(WEEKDAYS.index(d))
+    if not days:
+        raise ValueError(f"No working days given: {s!r}")
+    return days
+
 #
 # See what's on our command line.
 #
@@ -110,6 +146,10 @@ ap.add_argument('--start',metavar='YYYY-MM-DD',action='store',default=today,help
 ap.add_argument('--end',metavar='YYYY-MM-DD',action='store',default=today+dt.timedelta(days=DEFAULT_CALENDAR_WINDOW),help="Latest date to search for calendar entries. (default: %(default).10s)")
 ap.add_argument('--list',action='store_true',help="List the calendars available to the current user. Then quit.")
 ap.add_argument('--free-days',action='store_true',help="Report dates that contain no events.")
+ap.add_argument('--utilization',action='store_true',help="Report busy hours and the percentage of working hours booked per calendar, per week, and per day, along with the busiest days. Only busy events during working hours are counted, and overlapping events within a calendar are counted once. --max is ignored.")
+ap.add_argument('--work-hours',metavar='HH:MM-HH:MM',action='store',type=work_hours_validator,default='09:00-17:00',help="Working hours used by --utilization. (default: %(default)s)")
+ap.add_argument('--work-days',metavar='DAY[,...]',action='store',type=weekdays_validator,default='Mon,Tue,Wed,Thu,Fri',help="Working days used by --utilization. (default: %(default)s)")
+ap.add_argument('--csv',action='store_true',help="Write the --utilization report as CSV rather than as a table.")
 ap.add_argument('--max',metavar='N',action='store',type=positive_int,default=None,help="If given, this is the maximum number of entries to find.")
 ap.add_argument('--not',metavar="CALENDAR[,...]",dest='no',action='store',type=set_from_csv,default=set(),help="One or more calendars NOT to report events for. Separate multiple caldar names with commas.")
 ap.add_argument('--show',action='store',type=set_from_csv,default=set(),help="Set extra event attributes to be shown. Choices are attachments, busy, day, free, location, and notes. These maybe be combined in a single value of comma-separated items.")
@@ -117,6 +157,10 @@ ap.add_argument('--location',action='store_true',help="Show the location for eac
 ap.add_argument('--notes',action='store_true',help="Show notes for each event that has notes.")
 ap.add_argument('calendars',metavar='CALENDAR',type=CaselessString,nargs='*',action='store',help="The name(s) of one or more calendars to be searched. By default, all calendars are searched.")
 opt=ap.parse_args()
+if opt.utilization and opt.free_days:
+    ap.error("--utilization and --free-days cannot be used together.")
+if opt.csv and not opt.utilization:
+    ap.error("--csv can only be used with --utilization.")
 
 # Cook a few of our options' values a bit.
 dc.enable(opt.debug)
@@ -145,6 +189,9 @@ if dc:
     dc(f"{opt.max=}")
     dc(opt.no,'opt.no')
     dc(f"{opt.show=}")
+    dc(f"{opt.utilization=}")
+    dc(f"{opt.work_hours=}")
+    dc(f"{opt.work_days=}")
     dc(opt.calendars,'opt.calendars')
     dc(f"{RECORD_RESPONSES=}")
     dc(f"{RESPONSES_FILE=}")
@@ -424,6 +471,7 @@ class Calendar(list):
     def __init__(self,name,calendar_id,events=None):
         self.name=name
         self.id=calendar_id
+        self.tz=tz_local # Updated to the calendar's own timezone by get_events().
         super().__init__(events if events else [])
 
     @staticmethod
@@ -486,19 +534,31 @@ class Calendar(list):
         if opt.end.tzinfo is None:
             opt.end=opt.end.replace(tzinfo=ZoneInfo(str(tz_cal)))
 
-        res=calendar_service.events().list(
-            calendarId=calendar_id,
-            timeMin=opt.start.isoformat(),
-            timeMax=(opt.end+ONE_DAY).isoformat(),
-            maxResults=250,singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-        # For diagnostic and exploratory purposes, it is helpful to be able
-        # to see the raw response dictionary the API returns.
-        if RECORD_RESPONSES:
-            with open(RESPONSES_FILE,'a') as f:
-                print('\n---- calendar ----',file=f)
-                pprint(res,stream=f,width=200)
+        # The API returns events a page at a time, so keep asking for the
+        # next page until there isn't one.
+        events=[]
+        page_token=None
+        while True:
+            res=calendar_service.events().list(
+                calendarId=calendar_id,
+                timeMin=opt.start.isoformat(),
+                timeMax=(opt.end+ONE_DAY).isoformat(),
+                maxResults=2500,singleEvents=True,
+                orderBy='startTime',
+                pageToken=page_token
+            ).execute()
+            # For diagnostic and exploratory purposes, it is helpful to be able
+            # to see the raw response dictionary the API returns.
+            if RECORD_RESPONSES:
+                with open(RESPONSES_FILE,'a') as f:
+                    print('\n---- calendar ----',file=f)
+                    pprint(res,stream=f,width=200)
+            # Get our list of event dictionaries from the API's response.
+            events.extend(res.get('items',[]))
+            page_token=res.get('nextPageToken')
+            if not page_token:
+                break
+        dc(f"Events fetched: {len(events)}")
 
         # Remember this calendar's default timezone.
         tz_cal=res.get('timeZone')
@@ -506,12 +566,145 @@ class Calendar(list):
             die(f"Google's Calendar API reports no default timezone for the {calendar_id} calendar.")
         dc(f"Setting default timezone to {tz_cal} ...")
         tz_cal=ZoneInfo(tz_cal)
+        self.tz=tz_cal
 
-        # Get our list of event dictionaries from the API's response.
         # Convert them to CalendarEvent instances for easier handling.
-        events=res.get('items',[])
         return [CalendarEvent(e) for e in events]
             
+def busy_seconds(starts,ends,windows):
+    """Given NumPy arrays of the starts and ends of busy intervals and
+    an (N,2) array of [start,end) windows, all in epoch seconds, return
+    an array of the number of busy seconds falling in each window.
+    Overlapping intervals are only counted once."""
+
+    keep=ends>starts
+    if not keep.any():
+        return np.zeros(len(windows))
+    order=np.argsort(starts[keep],kind='stable')
+    s=starts[keep][order]
+    e=ends[keep][order]
+
+    # Merge overlapping intervals. A new interval begins wherever a start
+    # lies beyond the furthest end seen so far.
+    reach=np.maximum.accumulate(e)
+    first=np.flatnonzero(np.concatenate(([True],s[1:]>reach[:-1])))
+    s=s[first]
+    e=np.maximum.reduceat(e,first)
+
+    # covered(t) is the total busy time before t, so a window's busy time
+    # is just the difference of covered() at its two ends.
+    total=np.concatenate(([0.0],np.cumsum(e-s)))
+    def covered(t):
+        i=np.searchsorted(s,t,side='right')
+        overhang=np.clip(e[i-1]-t,0,None)
+        return total[i]-np.where(i>0,overhang,0)
+
+    return covered(windows[:,1])-covered(windows[:,0])
+
+def utilization(calendars,start,end):
+    """Given a list of Calendar instances and the start and end of the
+    reporting period, return a (days,busy,work) tuple, where days is
+    a list of the dates in that period, and busy and work are
+    (calendars,days) arrays of the busy and working seconds in each
+    calendar's day. Working hours are taken in each calendar's own
+    timezone."""
+
+    days=list(day_range(start,end))
+    ws,we=opt.work_hours
+    windows=np.array([
+        (
+            dt.datetime.combine(d,ws,cal.tz).timestamp(),
+            dt.datetime.combine(d,we,cal.tz).timestamp()
+        )
+            for cal in calendars
+                for d in days
+    ]).reshape(len(calendars),len(days),2)
+    # Non-working days get empty windows.
+    workday=np.array([d.weekday() in opt.work_days for d in days],dtype=bool)
+    windows[:,~workday,1]=windows[:,~workday,0]
+    work=windows[:,:,1]-windows[:,:,0]
+    if not windows.size:
+        return days,np.zeros(work.shape),work
+
+    # Lay each calendar's events out on its own stretch of the time line
+    # so that every calendar can be handled in a single pass.
+    lo=windows.min()
+    hi=windows.max()
+    span=hi-lo+1
+    starts=[]
+    ends=[]
+    offsets=[]
+    for i,cal in enumerate(calendars):
+        busy=[e for e in cal if e.busy]
+        n=len(busy)
+        starts.append(np.fromiter((e.start.timestamp() for e in busy),float,count=n))
+        ends.append(np.fromiter((e.end.timestamp() for e in busy),float,count=n))
+        offsets.append(np.full(n,i*span))
+    starts=np.concatenate(starts)
+    ends=np.concatenate(ends)
+    offsets=np.concatenate(offsets)
+    starts=np.clip(starts,lo,hi)-lo+offsets
+    ends=np.clip(ends,lo,hi)-lo+offsets
+    dc(f"Busy events: {len(starts)}")
+
+    # Each calendar's working windows, on that calendar's stretch.
+    shift=np.arange(len(calendars))*span
+    cal_windows=(windows-lo)+shift[:,np.newaxis,np.newaxis]
+    busy=busy_seconds(starts,ends,cal_windows.reshape(-1,2))
+    return days,busy.reshape(len(calendars),len(days)),work
+
+def utilization_report(calendars,start,end):
+    """Write busy hours and the percentage of working hours booked for
+    each calendar, week, and day, either as a table or as CSV."""
+
+    days,busy,work=utilization(calendars,start,end)
+
+    # Weeks are ISO weeks, so they begin on Mondays.
+    weeks=['%04d-W%02d'%d.isocalendar()[:2] for d in days]
+    week_names,week_index=np.unique(np.array(weeks,dtype=str),return_inverse=True)
+    day_busy=busy.sum(axis=0)
+    day_work=work.sum(axis=0)
+    rows=dict(
+        calendar=list(zip(
+            [cal.name for cal in calendars],
+            busy.sum(axis=1),
+            work.sum(axis=1)
+        )),
+        week=list(zip(
+            week_names,
+            np.bincount(week_index,weights=day_busy,minlength=len(week_names)),
+            np.bincount(week_index,weights=day_work,minlength=len(week_names))
+        )),
+        day=list(zip(
+            [d.strftime('%Y-%m-%d %a') for d in days],
+            day_busy,
+            day_work
+        ))
+    )
+    busiest=[i for i in np.argsort(-day_busy,kind='stable')[:BUSIEST_DAYS] if day_busy[i]>0]
+    rows['busiest']=[rows['day'][i] for i in busiest]
+
+    if opt.csv:
+        w=csv.writer(sys.stdout)
+        w.writerow(['scope','name','busy_hours','work_hours','utilization'])
+        for scope in ('calendar','week','day'):
+            for name,b,t in rows[scope]:
+                w.writerow([scope,name,f"{b/3600:.2f}",f"{t/3600:.2f}",f"{b/t:.4f}" if t else ''])
+        return
+
+    width=max([len(str(name)) for l in rows.values() for name,b,t in l]+[10])
+    first=True
+    for scope,title in (('calendar','Calendar'),('week','Week'),('day','Day'),('busiest','Busiest Day')):
+        if not rows[scope]:
+            continue
+        if not first:
+            print()
+        first=False
+        print(f"{title:<{width}}  {'Busy':>8}  {'Work':>8}  {'Util':>6}")
+        for name,b,t in rows[scope]:
+            util=f"{100*b/t:5.1f}%" if t else '     -'
+            print(f"{name:<{width}}  {b/3600:8.2f}  {t/3600:8.2f}  {util}")
+
 def authenticate():
     """
     Return the authenticated API service.
@@ -592,13 +785,20 @@ def main():
         # Get CalendarEvent items from our list of calendars.
         dc(f"Calendars found: {len(calendars)}")
         events=[]
+        cals=[]
         for cname,cid in calendars.items():
             dc(f"Calendar {cname} (id={cid})").indent()
             cal=Calendar(cname,cid)
             l=cal.get_events(service,cid)
+            cal.extend(l)
+            cals.append(cal)
             events.extend(l)
             dc.undent()
 
+        if opt.utilization:
+            utilization_report(cals,opt.start,opt.end)
+            sys.exit(0)
+
         # Sort our CalenderEvent objects by start time.
         events.sort(key=lambda e:e.start)
 